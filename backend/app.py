@@ -11,6 +11,7 @@ from flask_cors import CORS
 from backend.razorpay_utils import save_keys, create_upi_order, check_payment_status
 from backend.routes import routes
 from backend.scheduler import start_scheduler
+from backend.services import warm_search_index, recover_payments
 
 def create_app():
     """Application factory pattern"""
@@ -19,6 +20,10 @@ def create_app():
     
     # Register the blueprint
     app.register_blueprint(routes, url_prefix='/api')
+    recover_payments()
+    # The search index is millions of long-lived objects at 1M customers; freezing
+    # them once built keeps full GC passes (and the pauses they add to requests) short
+    warm_search_index(freeze_gc=True)
     
     return app
 
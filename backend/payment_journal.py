@@ -0,0 +1,290 @@
+# backend/payment_journal.py
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+SUBMIT_TIMEOUT = 30   # seconds a caller waits for its payment to be applied
+RETRY_DELAY = 1       # seconds between attempts to re-apply a batch that failed
+KEEP_KEYS = 10000     # committed keys remembered for idempotent retries
+COMPACT_EVERY = 1000  # committed payments between journal compactions
+
+
+class IdempotencyConflict(Exception):
+    """An idempotency key was reused for a different payment"""
+
+
+class PaymentPending(Exception):
+    """The payment is journaled but not applied yet; retry with the same key"""
+
+
+def _jsonable(value):
+    """json.dumps fallback for numpy/pandas scalars coming out of DataFrames"""
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+class PaymentJournal:
+    """
+    Append-only write-ahead journal for payments (one JSON record per line).
+    - "intent": written and fsynced before any CSV is touched; carries the
+      key, a fingerprint of the request, the computed new due and what
+      replay and a repeated key need
+    - "commit": written once the CSVs are updated
+    - "abort": the intent was never applied and was reported as failed
+    - "done": a committed key kept by compaction for idempotent retries
+    A background committer groups every intent queued during the previous
+    fsync into one write + fsync, applies the whole batch through
+    apply_batch(entries, replay) and then commits it. A batch that fails
+    to apply or to commit is left uncommitted and retried together with
+    later intents, so no intent ever commits ahead of an earlier one
+    (apply_batch must be idempotent); on start, intents without a
+    commit/abort are replayed.
+    """
+
+    def __init__(self, path, apply_batch, timeout=SUBMIT_TIMEOUT, retry_delay=RETRY_DELAY,
+                 keep_keys=KEEP_KEYS, compact_every=COMPACT_EVERY):
+        self.path = path
+        self.apply_batch = apply_batch
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.keep_keys = keep_keys
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._started = False
+        self._queue = []              # intents waiting for the next group commit
+        self._retry = []              # journaled intents whose apply failed, retried first
+        self._results = OrderedDict() # key -> {"fingerprint", "response"}; response None = aborted
+        self._inflight = {}           # key -> intent not yet committed
+        self._pending_due = {}        # customer id -> latest journaled, not yet applied intent
+        self._failed = None           # why the journal can't be written; payments refused until restart
+        self._since_compact = 0
+        self._seq = 0
+
+    # ---------------- Startup / Replay ----------------
+    def start(self):
+        """Replay uncommitted intents, compact and start the committer (safe to call repeatedly)"""
+        with self._lock:
+            if self._started:
+                return
+            intents = self._read_journal()
+            if intents:
+                print(f"[INFO] Replaying {len(intents)} uncommitted payment(s) from journal")
+                self.apply_batch(intents, replay=True)
+                self._write([{"type": "commit", "key": e["key"]} for e in intents])
+                for entry in intents:
+                    self._remember(entry["key"], entry["fingerprint"], entry["response"])
+            self._compact(self._snapshot())
+            threading.Thread(target=self._committer, daemon=True).start()
+            self._started = True
+
+    def _read_journal(self):
+        """Load finished keys into _results and return intents still awaiting a commit"""
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                # Torn final write from a crash; it was never acknowledged
+                data = data[:data.rfind(b"\n") + 1]
+                f.truncate(len(data))
+        intents = {}
+        for line in data.decode("utf-8").splitlines():
+            record = json.loads(line)
+            key = record["key"]
+            if record["type"] == "intent":
+                intents[key] = record
+                self._seq = max(self._seq, record["seq"])
+            elif record["type"] == "commit" and key in intents:
+                entry = intents.pop(key)
+                self._remember(key, entry["fingerprint"], entry["response"])
+            elif record["type"] == "abort":
+                intents.pop(key, None)
+                self._remember(key, record["fingerprint"], None)
+            elif record["type"] == "done":
+                self._remember(key, record["fingerprint"], record["response"])
+        return sorted(intents.values(), key=lambda e: e["seq"])
+
+    def _remember(self, key, fingerprint, response):
+        self._results[key] = {"fingerprint": fingerprint, "response": response}
+        self._results.move_to_end(key)
+        while len(self._results) > self.keep_keys:
+            self._results.popitem(last=False)
+
+    def _snapshot(self):
+        """Records a compacted journal needs: remembered keys plus intents awaiting a commit (caller holds the lock)"""
+        self._since_compact = 0
+        records = [{"type": "done", "key": key, **result} for key, result in self._results.items()]
+        return records + self._retry
+
+    def _compact(self, records):
+        """Atomically replace the journal with records"""
+        tmp = f"{self.path}.tmp"
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(r, default=_jsonable) + "\n" for r in records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    # ---------------- Submitting payments ----------------
+    def pending_due(self, customer_id):
+        """New due of the latest journaled but not yet applied payment for a customer, else None"""
+        entry = self._pending_due.get(customer_id)
+        return None if entry is None else entry["new_due"]
+
+    @contextmanager
+    def settled(self, customer_id):
+        """
+        For writers that set a customer's due outside the journal: wait until the
+        customer's journaled payments are applied, then hold off new payments
+        while the block runs, so no payment computed from an older due lands after it.
+        Raises PaymentPending if the payments aren't applied within the timeout.
+        """
+        with self._cond:
+            deadline = time.monotonic() + self.timeout
+            while customer_id in self._pending_due:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PaymentPending(f"Payments for customer {customer_id} are not applied yet")
+                self._cond.wait(remaining)
+            yield
+
+    def submit(self, key, fingerprint, make_entry):
+        """
+        Journal and apply one payment, blocking until it's durable and applied.
+        make_entry() runs under the journal lock and returns the intent dict
+        (customer_id, new_due, response, ...) or None to reject the payment.
+        A key seen before returns the original response (None if it failed)
+        without re-applying; IdempotencyConflict if the fingerprint differs.
+        Raises PaymentPending if the payment isn't applied within the timeout.
+        """
+        self.start()
+        with self._cond:
+            known = self._results.get(key) or self._inflight.get(key)
+            if known is not None:
+                if known["fingerprint"] != fingerprint:
+                    raise IdempotencyConflict(f"Idempotency key {key!r} was used for a different payment")
+            else:
+                if self._failed:
+                    print(f"[ERROR] Payment refused, journal unavailable: {self._failed}")
+                    return None
+                entry = make_entry()
+                if entry is None:
+                    return None
+                self._seq += 1
+                entry.update({"type": "intent", "key": key, "fingerprint": fingerprint, "seq": self._seq})
+                self._inflight[key] = entry
+                self._pending_due[entry["customer_id"]] = entry
+                self._queue.append(entry)
+                self._cond.notify_all()
+
+            deadline = time.monotonic() + self.timeout
+            while key not in self._results:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PaymentPending(f"Payment {key!r} is recorded but not applied yet")
+                self._cond.wait(remaining)
+            return self._results[key]["response"]
+
+    # ---------------- Group commit ----------------
+    def _committer(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._retry:
+                    self._cond.wait()
+                batch, self._queue = self._queue, []
+            try:
+                self._commit(batch)
+            except Exception as e:
+                print(f"[ERROR] Payment journal committer: {e}")
+                time.sleep(self.retry_delay)
+
+    def _commit(self, batch):
+        if batch:
+            try:
+                self._write(batch)
+            except Exception as e:
+                print(f"[ERROR] Failed to journal payments: {e}")
+                self._abort(batch)
+                return
+
+        replay = bool(self._retry)  # a retried batch may already be partly applied
+        batch = self._retry + batch
+        try:
+            self.apply_batch(batch, replay=replay)
+        except Exception as e:
+            # Some files may already be rewritten; the intents stay uncommitted and are re-applied
+            print(f"[ERROR] Failed to apply payments, retrying: {e}")
+            self._retry = batch
+            time.sleep(self.retry_delay)
+            return
+
+        try:
+            self._write([{"type": "commit", "key": e["key"]} for e in batch])
+        except Exception as e:
+            # Applied but not committed: a restart would replay these intents, so
+            # later payments must not commit (and be rolled back by that replay) first
+            print(f"[ERROR] Failed to journal payment commits, retrying: {e}")
+            self._retry = batch
+            time.sleep(self.retry_delay)
+            return
+        self._retry = []
+        with self._cond:
+            for entry in batch:
+                self._settle(entry, entry["response"])
+            self._since_compact += len(batch)
+            records = self._snapshot() if self._since_compact >= self.compact_every else None
+        try:
+            if records is not None:
+                self._compact(records)
+        finally:
+            with self._cond:
+                self._cond.notify_all()
+
+    def _abort(self, batch):
+        """Fail intents whose journal write failed, plus queued ones that may build on them"""
+        with self._cond:
+            batch = batch + self._queue
+            self._queue = []
+        try:
+            self._write([{"type": "abort", "key": e["key"], "fingerprint": e["fingerprint"]} for e in batch])
+        except Exception as e:
+            # Can't tell whether the intents reached the disk: leave them pending for replay
+            print(f"[ERROR] Payment journal unavailable until restart: {e}")
+            with self._cond:
+                self._failed = str(e)
+                for entry in batch:
+                    if self._pending_due.get(entry["customer_id"]) is entry:
+                        del self._pending_due[entry["customer_id"]]
+            return
+        with self._cond:
+            for entry in batch:
+                self._settle(entry, None)
+            # Intents still being retried remain the latest due for their customers
+            for entry in self._retry:
+                latest = self._pending_due.get(entry["customer_id"])
+                if latest is None or latest["seq"] < entry["seq"]:
+                    self._pending_due[entry["customer_id"]] = entry
+            self._cond.notify_all()
+
+    def _settle(self, entry, response):
+        """Record the outcome of an intent (caller holds the lock)"""
+        self._inflight.pop(entry["key"], None)
+        if self._pending_due.get(entry["customer_id"]) is entry:
+            del self._pending_due[entry["customer_id"]]
+        self._remember(entry["key"], entry["fingerprint"], response)
+
+    def _write(self, records):
+        """Append records and fsync once for the whole group"""
+        if not records:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(r, default=_jsonable) + "\n" for r in records))
+            f.flush()
+            os.fsync(f.fileno())
@@ -12,10 +12,11 @@ from backend.services import (
     record_partial_payment, delete_customer, delete_all_customers,
     login_user, get_recent_activity, user_pay_due,
     user_delete_account, get_user_transactions,
-    reset_credentials  # All required imports
+    reset_credentials, search_customers  # All required imports
 )
 from backend.notifications.email_service import send_email, shop_name
 from backend.razorpay_utils import save_keys, create_upi_order, check_payment_status
+from backend.payment_journal import IdempotencyConflict, PaymentPending
 # ============== AUTHENTICATION ROUTES ==============
 @routes.route("/user/login", methods=["POST"])
 def api_login_user():
@@ -33,6 +34,18 @@ def api_get_customers():
     active_only = request.args.get("active_only", "false").lower() == "true"
     return jsonify(get_all_customers(active_only=active_only))
 
+@routes.route("/admin/customers/search", methods=["GET"])
+def api_search_customers():
+    query = request.args.get("q", "")
+    try:
+        limit = min(max(int(request.args.get("limit", 20)), 1), 100)
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+    results = search_customers(query, limit=limit)
+    if results is None:
+        return jsonify({"error": "Search index is still loading, try again shortly"}), 503
+    return jsonify(results)
+
 @routes.route("/admin/customer/add", methods=["POST"])
 def api_add_customer():
     data = request.json
@@ -141,7 +154,10 @@ def payment_status(payment_id):
 @routes.route("/admin/customer/update_due", methods=["POST"])
 def api_update_due():
     data = request.json
-    cust = update_due(data.get("id"), data.get("new_due"))
+    try:
+        cust = update_due(data.get("id"), data.get("new_due"))
+    except PaymentPending as e:
+        return jsonify({"error": str(e)}), 409
     if not cust:
         return jsonify({"error": "Customer not found"}), 404
     return jsonify(cust)
@@ -171,11 +187,17 @@ def api_user_transactions():
 @routes.route("/user/due/pay", methods=["POST"])
 def api_user_pay_due():
     data = request.json
-    cust = user_pay_due(
-        username=data.get("username"),
-        customer_id=data.get("customer_id"),
-        amount=data.get("amount")
-    )
+    try:
+        cust = user_pay_due(
+            username=data.get("username"),
+            customer_id=data.get("customer_id"),
+            amount=data.get("amount"),
+            idempotency_key=request.headers.get("Idempotency-Key") or data.get("idempotency_key")
+        )
+    except IdempotencyConflict as e:
+        return jsonify({"error": str(e)}), 409
+    except PaymentPending as e:
+        return jsonify({"status": "pending", "message": str(e)}), 202
     if not cust:
         return jsonify({"error": "Payment failed"}), 400
     return jsonify(cust)
@@ -0,0 +1,360 @@
+# backend/search_index.py
+import re
+import heapq
+import threading
+from bisect import bisect_left, insort
+
+SEARCH_FIELDS = ("name", "phone", "email", "username")
+_PHONE_QUERY = re.compile(r'^[\d\s\-+()]+$')
+_SPLIT = re.compile(r'[^a-z0-9]+')
+_PREFIX_SCAN_LIMIT = 2000  # max tokens walked per prefix lookup, keeps 1-2 char queries cheap
+_CANDIDATE_LIMIT = 2000    # customers scored per query, best ranked first; keeps "mail" cheap
+_SCORE_ALL_LIMIT = 10000   # full matches up to this many are all scored directly
+
+
+def _display(value):
+    """Turn a CSV cell (possibly NaN/None, or a phone read back as float) into a string"""
+    if value is None or value != value:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def _clean(value):
+    return _display(value).lower()
+
+
+def _tokens_for(record):
+    """All searchable tokens for a customer record"""
+    tokens = set()
+    for field in SEARCH_FIELDS:
+        value = _clean(record.get(field))
+        if not value:
+            continue
+        if field == "phone":
+            digits = re.sub(r'\D', '', value)
+            if digits:
+                tokens.add(digits)
+            continue
+        tokens.update(t for t in _SPLIT.split(value) if t)
+    return tokens
+
+
+def _trigrams(token):
+    """Trigrams of a token, anchored at the start with '$'"""
+    padded = "$" + token
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _edit_distance(a, b, max_dist):
+    """Levenshtein distance, giving up (returning max_dist + 1) once it exceeds max_dist"""
+    if abs(len(a) - len(b)) > max_dist:
+        return max_dist + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+        if min(cur) > max_dist:
+            return max_dist + 1
+        prev = cur
+    return prev[-1]
+
+
+def _max_typos(term):
+    if len(term) < 4:
+        return 0
+    return 1 if len(term) < 8 else 2
+
+
+def _token_score(term, token, loose):
+    """Score of one indexed token for one query term: exact > prefix > substring > typo, 0 if no match"""
+    if token == term:
+        return 1.0
+    if token.startswith(term):
+        return 0.7 + 0.2 * len(term) / len(token)
+    if not loose or len(term) < 3:
+        return 0
+    if term in token:
+        return 0.5
+    max_dist = _max_typos(term)
+    if max_dist and abs(len(token) - len(term)) <= max_dist:
+        dist = _edit_distance(term, token, max_dist)
+        if dist <= max_dist:
+            return 0.4 - 0.1 * dist
+    return 0
+
+
+class CustomerSearchIndex:
+    """
+    In-memory index over customer name, phone, email and username.
+    - sorted token list for prefix lookups (bisect)
+    - (trigram, token length) -> tokens map for substring and typo-tolerant
+      matches; keying on length lets typo lookups skip tokens that can't be close
+    - token -> customer ids map to resolve matches back to customers
+    The index is built off-lock by build() and then kept up to date through
+    add/update/remove/clear; mutations made during a build are buffered and
+    replayed before the new index is swapped in.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._pending = None   # mutations buffered while a build runs, None otherwise
+        self._clear()
+
+    # ---------------- Maintenance ----------------
+    @property
+    def ready(self):
+        return self._loaded
+
+    @property
+    def building(self):
+        return self._pending is not None
+
+    def build(self, loader):
+        """Build the index from loader() (customer records); no-op if built or already building"""
+        with self._lock:
+            if self._loaded or self._pending is not None:
+                return
+            self._pending = []
+        fresh = CustomerSearchIndex()
+        try:
+            for record in loader():
+                fresh._add(record, bulk=True)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        fresh._sorted = sorted(fresh._postings)
+        with self._lock:
+            for op, arg in self._pending:
+                getattr(fresh, op)(arg)
+            self._records, self._doc_tokens = fresh._records, fresh._doc_tokens
+            self._postings, self._grams = fresh._postings, fresh._grams
+            self._sorted, self._max_len = fresh._sorted, fresh._max_len
+            self._pending = None
+            self._loaded = True
+
+    def add(self, record):
+        self._mutate("_add", record)
+
+    def update(self, record):
+        self._mutate("_add", record)  # _add replaces an existing entry
+
+    def remove(self, customer_id):
+        self._mutate("_remove", customer_id)
+
+    def clear(self):
+        self._mutate("_clear", None)
+
+    def _mutate(self, op, arg):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((op, arg))
+            elif self._loaded:
+                getattr(self, op)(arg)
+
+    def _clear(self, _=None):
+        self._records = {}     # id -> searchable fields
+        self._doc_tokens = {}  # id -> tokens
+        self._postings = {}    # token -> {ids}
+        self._grams = {}       # (trigram, len(token)) -> {tokens}
+        self._sorted = []      # all distinct tokens, sorted
+        self._max_len = 0      # longest token ever indexed (bounds substring lookups)
+
+    def _add(self, record, bulk=False):
+        cid = int(record["id"])
+        if cid in self._records:
+            self._remove(cid)
+        tokens = _tokens_for(record)
+        self._records[cid] = {"id": cid, **{f: _display(record.get(f)) for f in SEARCH_FIELDS}}
+        self._doc_tokens[cid] = tokens
+        for token in tokens:
+            ids = self._postings.get(token)
+            if ids is None:
+                ids = self._postings[token] = set()
+                if not bulk:
+                    insort(self._sorted, token)
+                self._max_len = max(self._max_len, len(token))
+                for gram in _trigrams(token):
+                    self._grams.setdefault((gram, len(token)), set()).add(token)
+            ids.add(cid)
+
+    def _remove(self, customer_id):
+        cid = int(customer_id)
+        tokens = self._doc_tokens.pop(cid, None)
+        if tokens is None:
+            return
+        self._records.pop(cid, None)
+        for token in tokens:
+            ids = self._postings.get(token)
+            if ids is None:
+                continue
+            ids.discard(cid)
+            if ids:
+                continue
+            del self._postings[token]
+            pos = bisect_left(self._sorted, token)
+            if pos < len(self._sorted) and self._sorted[pos] == token:
+                del self._sorted[pos]
+            for gram in _trigrams(token):
+                key = (gram, len(token))
+                bucket = self._grams.get(key)
+                if bucket is not None:
+                    bucket.discard(token)
+                    if not bucket:
+                        del self._grams[key]
+
+    # ---------------- Lookup ----------------
+    def _match_term(self, term, loose):
+        """
+        Return {token: score} for indexed tokens matching a single query term.
+        loose=False: exact and prefix matches only; loose=True adds substring and typo matches.
+        """
+        matches = {}
+        if term in self._postings:
+            matches[term] = 1.0
+
+        # Prefix matches
+        pos = bisect_left(self._sorted, term)
+        end = min(len(self._sorted), pos + _PREFIX_SCAN_LIMIT)
+        while pos < end and self._sorted[pos].startswith(term):
+            matches[self._sorted[pos]] = _token_score(term, self._sorted[pos], loose)
+            pos += 1
+
+        if not loose or len(term) < 3:
+            return matches
+
+        # Substring matches (e.g. the last digits of a phone number)
+        grams = _trigrams(term) - {"$" + term[:2]}
+        for length in range(len(term), self._max_len + 1):
+            buckets = [self._grams.get((gram, length)) for gram in grams]
+            if not all(buckets):
+                continue
+            buckets.sort(key=len)
+            candidates = set(buckets[0])
+            for bucket in buckets[1:]:
+                candidates &= bucket
+                if not candidates:
+                    break
+            for token in candidates:
+                if token not in matches and term in token:
+                    matches[token] = 0.5
+
+        # Typo-tolerant matches against whole tokens of similar length
+        max_dist = _max_typos(term)
+        if max_dist:
+            term_grams = _trigrams(term)
+            shared = {}
+            for length in range(len(term) - max_dist, len(term) + max_dist + 1):
+                for gram in term_grams:
+                    for token in self._grams.get((gram, length), ()):
+                        shared[token] = shared.get(token, 0) + 1
+            needed = max(1, len(term_grams) - 3 * max_dist)
+            for token, count in shared.items():
+                if count < needed or token in matches:
+                    continue
+                score = _token_score(term, token, loose)
+                if score:
+                    matches[token] = score
+        return matches
+
+    def search(self, query, limit=20):
+        """
+        Ranked customer search. Every query term must match some field;
+        a customer's score is the sum of its best match per term.
+        The loose (substring/typo) pass only runs when exact/prefix matches
+        can't fill the limit and some term has no exact token match, and
+        only widens the terms without one.
+        """
+        query = _clean(query)
+        if not query:
+            return []
+        if _PHONE_QUERY.match(query) and re.search(r'\d', query):
+            terms = [re.sub(r'\D', '', query)]
+        else:
+            terms = [t for t in _SPLIT.split(query) if t]
+        if not terms:
+            return []
+
+        with self._lock:
+            scores = self._score(terms, limit, loose=False)
+            if len(scores) < limit and not all(term in self._postings for term in terms):
+                scores = self._score(terms, limit, loose=True)
+
+            best = heapq.nsmallest(
+                limit, scores.items(),
+                key=lambda item: (-item[1], self._records[item[0]]["name"], item[0])
+            )
+            return [{**self._records[cid], "score": round(score, 3)} for cid, score in best]
+
+    def _candidates(self, matches, sizes):
+        """
+        Ids of customers matching every term: the posting sets of each term's
+        matched tokens, intersected smallest term first. A term much larger
+        than the running intersection is checked against each remaining
+        customer's own tokens instead of building its posting union.
+        """
+        order = sorted(range(len(matches)), key=sizes.__getitem__)
+        ids = set().union(*(self._postings[token] for token in matches[order[0]]))
+        for i in order[1:]:
+            if not ids:
+                break
+            if sizes[i] <= 4 * len(ids):
+                ids &= set().union(*(self._postings[token] for token in matches[i]))
+            else:
+                ids = {cid for cid in ids if any(t in matches[i] for t in self._doc_tokens[cid])}
+        return ids
+
+    def _score(self, terms, limit, loose):
+        """
+        {customer id: score} for customers matching every term.
+        Multi-term queries intersect the terms' postings first (_candidates),
+        so a customer matching every term is never crowded out by partial
+        matches; a small intersection is scored in full. Otherwise customers
+        are scored best ranked first and _CANDIDATE_LIMIT is only a cutoff
+        on that ranking.
+        """
+        # Substring/typo matching is only for terms without an exact token
+        matches = [self._match_term(term, loose and term not in self._postings) for term in terms]
+        if not all(matches):
+            return {}
+        sizes = [sum(map(len, map(self._postings.__getitem__, m))) for m in matches]
+        if len(terms) > 1 and min(sizes) <= _SCORE_ALL_LIMIT:
+            # At most that many full matches: find and score them all
+            allowed = self._candidates(matches, sizes)
+            if len(allowed) <= _SCORE_ALL_LIMIT:
+                return {cid: sum(max(m.get(t, 0) for t in self._doc_tokens[cid]) for m in matches)
+                        for cid in allowed}
+
+        # Too many to score: walk token combinations (one token per term) best
+        # total first; a customer's first combination is its best, so every
+        # customer scored outranks every customer skipped by the cutoff
+        ranked = [sorted(m.items(), key=lambda item: -item[1]) for m in matches]
+        first = (0,) * len(ranked)
+        heap, queued = [(-sum(r[0][1] for r in ranked), first)], {first}
+        scores, prev = {}, None
+        while heap:
+            total, combo = heapq.heappop(heap)
+            total = -total
+            if len(scores) >= limit and total < prev:
+                break  # every remaining combination ranks lower
+            prev = total
+            sets = sorted((self._postings[ranked[i][j][0]] for i, j in enumerate(combo)), key=len)
+            for cid in sets[0].intersection(*sets[1:]) if len(sets) > 1 else sets[0]:
+                if cid not in scores:
+                    scores[cid] = total
+                    if len(scores) >= _CANDIDATE_LIMIT:
+                        return scores
+            for i, j in enumerate(combo):
+                if j + 1 < len(ranked[i]):
+                    nxt = combo[:i] + (j + 1,) + combo[i + 1:]
+                    if nxt not in queued:
+                        queued.add(nxt)
+                        heapq.heappush(heap, (-(total - ranked[i][j][1] + ranked[i][j + 1][1]), nxt))
+        return scores
+
+
+customer_index = CustomerSearchIndex()
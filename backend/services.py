@@ -1,10 +1,16 @@
 # backend/services.py
 import os
+import gc
 import pandas as pd
 import secrets
 import string
+import threading
+import uuid
 from datetime import datetime
+from functools import wraps
 from werkzeug.security import generate_password_hash, check_password_hash
+from backend.search_index import customer_index
+from backend.payment_journal import PaymentJournal
 
 DATA_PATH = os.path.join(os.path.dirname(__file__), "data")
 CUSTOMERS_CSV = os.path.join(DATA_PATH, "customers.csv")
@@ -19,6 +25,7 @@ SIGNIN_CSV = os.path.join(DATA_PATH, "signin.csv")  # User login
 USER_PAYMENT_CSV = os.path.join(DATA_PATH, "user_payment_updated.csv")
 USER_DELETED_CSV = os.path.join(DATA_PATH, "user_account_deleted.csv")
 SIGNIN_LOGS_CSV = os.path.join(DATA_PATH, "signin_logs.csv")  # NEW for login tracking
+PAYMENT_JOURNAL = os.path.join(DATA_PATH, "payments_journal.jsonl")  # Write-ahead journal for payments
 
 os.makedirs(DATA_PATH, exist_ok=True)
 
@@ -27,10 +34,45 @@ def _load_csv(file, cols=None):
     return pd.read_csv(file) if os.path.exists(file) else pd.DataFrame(columns=cols or [])
 
 def _append_csv(file, row):
-    pd.DataFrame([row]).to_csv(file, mode='a', header=not os.path.exists(file), index=False)
+    header = not os.path.exists(file)
+    with open(file, 'a', newline='', encoding='utf-8') as f:
+        pd.DataFrame([row]).to_csv(f, header=header, index=False)
+        f.flush()
+        os.fsync(f.fileno())
+    if header:
+        _fsync_dir(file)
 
 def _save_csv(df, file):
-    df.to_csv(file, index=False)
+    # Write, fsync, then rename so readers and crash recovery never see a half-written
+    # file, and a journaled payment commit never outlives the rows it committed
+    tmp = f"{file}.tmp"
+    with open(tmp, 'w', newline='', encoding='utf-8') as f:
+        df.to_csv(f, index=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, file)
+    _fsync_dir(file)
+
+def _fsync_dir(file):
+    """Make a file created or renamed into place survive a power loss (a no-op on Windows)"""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(os.path.dirname(file) or ".", os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# Every read-modify-write of customers.csv / dues.csv holds this lock, including the
+# payment journal's committer, so a full-file rewrite never drops another writer's change
+_csv_lock = threading.RLock()
+
+def _csv_writer(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with _csv_lock:
+            return func(*args, **kwargs)
+    return wrapper
 
 def _generate_credentials(name):
     """Generate username from name and password as name + random numbers"""
@@ -51,6 +93,29 @@ def get_all_customers(active_only=False):
         df = df[df['status'] == 'active']
     return df.to_dict(orient='records')
 
+def search_customers(query, limit=20):
+    """Ranked prefix/substring/typo-tolerant search over name, phone, email and username.
+    Returns None while the index is still being built."""
+    if not customer_index.ready:
+        warm_search_index()
+        return None
+    return customer_index.search(query, limit=limit)
+
+def warm_search_index(freeze_gc=False):
+    """Build the search index in a background thread, unless it's built or already building.
+    freeze_gc: after the build, move everything live into the GC's permanent generation
+    (for app startup; see create_app)"""
+    if customer_index.ready or customer_index.building:
+        return
+    threading.Thread(target=_build_search_index, args=(freeze_gc,), daemon=True).start()
+
+def _build_search_index(freeze_gc):
+    customer_index.build(get_all_customers)
+    if freeze_gc and customer_index.ready:
+        gc.collect()  # collect garbage left by the CSV load first, or it would be frozen too
+        gc.freeze()
+
+@_csv_writer
 def add_customer(name, phone, address, due, category="Regular", email=""):
     df = _load_csv(CUSTOMERS_CSV)
     new_id = (df['id'].max() or 0) + 1 if not df.empty else 1
@@ -69,6 +134,7 @@ def add_customer(name, phone, address, due, category="Regular", email=""):
     # Save to main CSV
     df = pd.concat([df, pd.DataFrame([cust])], ignore_index=True)
     _save_csv(df, CUSTOMERS_CSV)
+    customer_index.add(cust)
     
     # Append to added_customers.csv with only intended columns
     _append_csv(ADDED_CSV, {
@@ -86,6 +152,7 @@ def add_customer(name, phone, address, due, category="Regular", email=""):
     
     return {**cust, "password": password}  # Return plain password for email
 
+@_csv_writer
 def reset_credentials(customer_id, new_username=None, new_password=None):
     """NEW: Allow admin to reset customer credentials"""
     df = _load_csv(CUSTOMERS_CSV)
@@ -104,6 +171,7 @@ def reset_credentials(customer_id, new_username=None, new_password=None):
         updates['last_update'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         df.loc[df['id'] == customer_id, list(updates.keys())] = list(updates.values())
         _save_csv(df, CUSTOMERS_CSV)
+        customer_index.update({**cust, **updates})
     
     return {
         **cust,
@@ -112,6 +180,12 @@ def reset_credentials(customer_id, new_username=None, new_password=None):
     }
 
 def update_due(customer_id, new_due):
+    # Payments already journaled for the customer were computed from the old due; let them land first
+    with payment_journal.settled(customer_id):
+        return _update_due(customer_id, new_due)
+
+@_csv_writer
+def _update_due(customer_id, new_due):
     df = _load_csv(CUSTOMERS_CSV)
     if customer_id not in df['id'].values:
         return None
@@ -133,30 +207,28 @@ def update_due(customer_id, new_due):
     return cust
 
 
-def record_partial_payment(customer_id, amount):
-    df = _load_csv(CUSTOMERS_CSV)
-    if customer_id not in df['id'].values:
-        return None
-    cust = df[df['id'] == customer_id].iloc[0].to_dict()
-    new_due = float(cust['due']) - float(amount)
-    now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    df.loc[df['id'] == customer_id, ["due", "last_update"]] = [new_due, now_str]
-    _save_csv(df, CUSTOMERS_CSV)
-    
-    # Append to partial_customers.csv with only intended columns
-    _append_csv(PARTIAL_CSV, {
-        "id": cust["id"], "name": cust["name"], "phone": cust["phone"],
-        "email": cust["email"], "address": cust["address"], "due": cust["due"],
-        "last_update": cust["last_update"], "status": cust["status"],
-        "partial_due": new_due, "partial_at": now_str
-    })
-    
-    # Sync with dues
-    update_due_record(customer_id, new_due, last_message_date=now_str)
-    cust.update({"due": new_due, "partial_due": new_due, "partial_at": now_str})
-    return cust
+def record_partial_payment(customer_id, amount, idempotency_key=None):
+    def make_entry():
+        cust = _current_customer(customer_id)
+        if cust is None:
+            return None
+        new_due = float(cust['due']) - float(amount)
+        now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return {
+            "kind": "partial", "customer_id": customer_id, "new_due": new_due, "paid_at": now_str,
+            # Row for partial_customers.csv with only intended columns
+            "log": {
+                "id": cust["id"], "name": cust["name"], "phone": cust["phone"],
+                "email": cust["email"], "address": cust["address"], "due": cust["due"],
+                "last_update": cust["last_update"], "status": cust["status"],
+                "partial_due": new_due, "partial_at": now_str
+            },
+            "response": {**_without_secrets(cust), "due": new_due, "partial_due": new_due, "partial_at": now_str}
+        }
+    return _submit_payment("partial", customer_id, amount, idempotency_key, make_entry)
 
 
+@_csv_writer
 def delete_customer(customer_id):
     df = _load_csv(CUSTOMERS_CSV)
     if customer_id not in df['id'].values:
@@ -164,6 +236,7 @@ def delete_customer(customer_id):
     cust = df[df['id'] == customer_id].iloc[0].to_dict()
     df = df[df['id'] != customer_id]
     _save_csv(df, CUSTOMERS_CSV)
+    customer_index.remove(customer_id)
     
     # Append to deleted_customers.csv with only intended columns
     _append_csv(DELETED_CSV, {
@@ -179,6 +252,7 @@ def delete_customer(customer_id):
     _save_csv(df_dues, DUES_CSV)
     return cust
 
+@_csv_writer
 def delete_all_customers():
     df = _load_csv(CUSTOMERS_CSV)
     if df.empty:
@@ -197,8 +271,10 @@ def delete_all_customers():
             "deleted_at": now_str
         })
     _save_csv(pd.DataFrame(columns=df.columns), CUSTOMERS_CSV)
+    customer_index.clear()
     _save_csv(pd.DataFrame(columns=_load_csv(DUES_CSV).columns), DUES_CSV)
 
+@_csv_writer
 def update_due_record(customer_id, new_due, last_message_date=None):
     df = _load_csv(DUES_CSV)
     if customer_id not in df['id'].values:
@@ -211,6 +287,66 @@ def update_due_record(customer_id, new_due, last_message_date=None):
         df.loc[df['id'] == customer_id, 'last_message_date'] = pd.Timestamp.now()
     _save_csv(df, DUES_CSV)
 
+# ---------------- Payment Journal ----------------
+def _current_customer(customer_id):
+    """Customer row with due reflecting payments journaled but not yet applied"""
+    df = _load_csv(CUSTOMERS_CSV)
+    if customer_id not in df['id'].values:
+        return None
+    cust = df[df['id'] == customer_id].iloc[0].to_dict()
+    pending_due = payment_journal.pending_due(customer_id)
+    if pending_due is not None:
+        cust['due'] = pending_due
+    return cust
+
+def _without_secrets(cust):
+    """Customer row as returned to clients and kept in the journal, minus the password hash"""
+    return {k: v for k, v in cust.items() if k != "password"}
+
+@_csv_writer
+def _apply_payments(entries, replay=False):
+    """
+    Apply a batch of journaled payments: customers.csv, dues.csv, then the payment logs.
+    Dues are set to absolute values and already-logged rows are skipped on replay,
+    so re-applying a batch after a crash never double-charges.
+    """
+    df = _load_csv(CUSTOMERS_CSV)
+    if not df.empty:
+        df['last_update'] = df['last_update'].astype(object)
+        for e in entries:
+            df.loc[df['id'] == e['customer_id'], ['due', 'last_update']] = [e['new_due'], e['paid_at']]
+        _save_csv(df, CUSTOMERS_CSV)
+
+    df_dues = _load_csv(DUES_CSV)
+    if not df_dues.empty:
+        df_dues['last_message_date'] = df_dues['last_message_date'].astype(object)
+        for e in entries:
+            df_dues.loc[df_dues['id'] == e['customer_id'], ['due_amount', 'last_message_date']] = [e['new_due'], e['paid_at']]
+        _save_csv(df_dues, DUES_CSV)
+
+    for e in entries:
+        if e['kind'] == "partial":
+            log_file, ts_col, due_col = PARTIAL_CSV, "partial_at", "partial_due"
+        else:
+            log_file, ts_col, due_col = USER_PAYMENT_CSV, "payment_date", "new_due"
+        if replay:
+            df_log = _load_csv(log_file)
+            if not df_log.empty and ((df_log['id'] == e['customer_id']) & (df_log[ts_col] == e['paid_at'])
+                                     & (df_log[due_col] == e['new_due'])).any():
+                continue
+        _append_csv(log_file, e['log'])
+
+payment_journal = PaymentJournal(PAYMENT_JOURNAL, _apply_payments)
+
+def _submit_payment(kind, customer_id, amount, idempotency_key, make_entry):
+    """Journal a payment; keys are scoped to the customer and tied to what was paid"""
+    key = f"{customer_id}:{idempotency_key or uuid.uuid4().hex}"
+    fingerprint = {"kind": kind, "customer_id": customer_id, "amount": float(amount)}
+    return payment_journal.submit(key, fingerprint, make_entry)
+
+def recover_payments():
+    """Replay payments left unapplied by a crash and start the journal committer"""
+    payment_journal.start()
 
 
 def get_recent_activity(limit=5):
@@ -271,20 +407,23 @@ def login_user(username, password):
     return {"success": False, "message": "Invalid credentials"}
     
 # ---------------- User Payments / Delete (Unchanged) ----------------
-def user_pay_due(username, customer_id, amount):
-    df_cust = _load_csv(CUSTOMERS_CSV)
-    if customer_id not in df_cust['id'].values:
-        return None
-    cust = df_cust[df_cust['id']==customer_id].iloc[0].to_dict()
-    new_due = float(cust['due']) - float(amount)
-    df_cust.loc[df_cust['id']==customer_id, ['due', 'last_update']] = [new_due, datetime.now().strftime("%Y-%m-%d %H:%M:%S")]
-    _save_csv(df_cust, CUSTOMERS_CSV)
-    update_due_record(customer_id, new_due)
-    # Log user payment
-    _append_csv(USER_PAYMENT_CSV, {"id": customer_id, "username": username, "name": cust['name'],
-                                   "amount_paid": amount, "new_due": new_due, "payment_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
-    return {**cust, "due": new_due}
+def user_pay_due(username, customer_id, amount, idempotency_key=None):
+    def make_entry():
+        cust = _current_customer(customer_id)
+        if cust is None:
+            return None
+        new_due = float(cust['due']) - float(amount)
+        now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return {
+            "kind": "user", "customer_id": customer_id, "new_due": new_due, "paid_at": now_str,
+            # Log user payment
+            "log": {"id": customer_id, "username": username, "name": cust['name'],
+                    "amount_paid": amount, "new_due": new_due, "payment_date": now_str},
+            "response": {**_without_secrets(cust), "due": new_due}
+        }
+    return _submit_payment("user", customer_id, amount, idempotency_key, make_entry)
 
+@_csv_writer
 def user_delete_account(username, customer_id):
     df_cust = _load_csv(CUSTOMERS_CSV)
     if customer_id not in df_cust['id'].values:
@@ -295,6 +434,7 @@ def user_delete_account(username, customer_id):
     # Delete customer
     df_cust = df_cust[df_cust['id'] != customer_id]
     _save_csv(df_cust, CUSTOMERS_CSV)
+    customer_index.remove(customer_id)
     # Remove from dues
     df_dues = _load_csv(DUES_CSV)
     df_dues = df_dues[df_dues['id'] != customer_id]
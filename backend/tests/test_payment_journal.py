@@ -0,0 +1,314 @@
+# backend/tests/test_payment_journal.py
+import os
+import json
+import threading
+
+import pandas as pd
+import pytest
+
+import backend.services as services
+from backend.payment_journal import PaymentJournal, IdempotencyConflict, PaymentPending
+
+
+class Crash(BaseException):
+    """Simulated process death: not caught by the committer, so the thread just stops"""
+
+
+@pytest.fixture
+def data(tmp_path, monkeypatch):
+    for name in ("CUSTOMERS_CSV", "DUES_CSV", "PARTIAL_CSV", "USER_PAYMENT_CSV", "UPDATED_CSV", "PAYMENT_JOURNAL"):
+        monkeypatch.setattr(services, name, str(tmp_path / os.path.basename(getattr(services, name))))
+    pd.DataFrame([
+        {"id": 1, "name": "Ravi", "phone": "9876543210", "email": "ravi@x.com", "address": "x", "due": 100.0,
+         "category": "Regular", "status": "active", "last_update": "2026-01-01 00:00:00",
+         "added_at": "2026-01-01 00:00:00", "username": "ravi", "password": "pbkdf2:secret-hash"},
+        {"id": 2, "name": "Priya", "phone": "9123443210", "email": "priya@y.in", "address": "y", "due": 50.0,
+         "category": "Regular", "status": "active", "last_update": "2026-01-01 00:00:00",
+         "added_at": "2026-01-01 00:00:00", "username": "priya", "password": "pbkdf2:secret-hash"},
+    ]).to_csv(services.CUSTOMERS_CSV, index=False)
+    pd.DataFrame([
+        {"id": 1, "name": "Ravi", "phone": "9876543210", "address": "x", "due_amount": 100.0,
+         "due_date": "2026-01-01", "last_message_date": ""},
+        {"id": 2, "name": "Priya", "phone": "9123443210", "address": "y", "due_amount": 50.0,
+         "due_date": "2026-01-01", "last_message_date": ""},
+    ]).to_csv(services.DUES_CSV, index=False)
+    restart(monkeypatch)
+    return tmp_path
+
+
+def restart(monkeypatch, **kwargs):
+    """Simulate a process (re)start: a fresh journal over the same file"""
+    kwargs.setdefault("timeout", 5)
+    kwargs.setdefault("retry_delay", 0.01)
+    journal = PaymentJournal(services.PAYMENT_JOURNAL, services._apply_payments, **kwargs)
+    monkeypatch.setattr(services, "payment_journal", journal)
+    services.recover_payments()
+    return journal
+
+
+def dues(customer_id=1):
+    customers = pd.read_csv(services.CUSTOMERS_CSV)
+    dues_df = pd.read_csv(services.DUES_CSV)
+    return (float(customers.loc[customers["id"] == customer_id, "due"].iloc[0]),
+            float(dues_df.loc[dues_df["id"] == customer_id, "due_amount"].iloc[0]))
+
+
+def log_rows(path=None):
+    path = path or services.USER_PAYMENT_CSV
+    return len(pd.read_csv(path)) if os.path.exists(path) else 0
+
+
+def journal_records():
+    with open(services.PAYMENT_JOURNAL, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+# ---------------- Idempotency ----------------
+def test_payment_applies_once_and_retry_returns_original(data):
+    first = services.user_pay_due("ravi", 1, 10, idempotency_key="k1")
+    again = services.user_pay_due("ravi", 1, 10, idempotency_key="k1")
+    assert first == again
+    assert (first["id"], first["name"], first["phone"], first["status"], first["due"]) == (1, "Ravi", 9876543210, "active", 90.0)
+    assert "password" not in first
+    assert dues() == (90.0, 90.0)
+    assert log_rows() == 1
+
+
+def test_key_is_scoped_to_customer(data):
+    services.user_pay_due("ravi", 1, 10, idempotency_key="k1")
+    other = services.user_pay_due("priya", 2, 5, idempotency_key="k1")
+    assert (other["id"], other["name"], other["due"]) == (2, "Priya", 45.0)
+    assert dues(1) == (90.0, 90.0)
+    assert dues(2) == (45.0, 45.0)
+
+
+def test_key_reused_for_different_payment_conflicts(data):
+    services.user_pay_due("ravi", 1, 10, idempotency_key="k1")
+    with pytest.raises(IdempotencyConflict):
+        services.user_pay_due("ravi", 1, 20, idempotency_key="k1")
+    with pytest.raises(IdempotencyConflict):
+        services.record_partial_payment(1, 10, idempotency_key="k1")
+    assert dues() == (90.0, 90.0)
+
+
+def test_keys_survive_restart(data, monkeypatch):
+    services.user_pay_due("ravi", 1, 10, idempotency_key="k1")
+    restart(monkeypatch)
+    assert services.user_pay_due("ravi", 1, 10, idempotency_key="k1")["due"] == 90.0
+    assert log_rows() == 1
+
+
+def test_journal_holds_no_customer_secrets(data):
+    services.user_pay_due("ravi", 1, 10)
+    partial = services.record_partial_payment(2, 5)
+    assert (partial["email"], partial["due"], partial["partial_due"]) == ("priya@y.in", 45.0, 45.0)
+    assert "password" not in partial
+    with open(services.PAYMENT_JOURNAL, encoding="utf-8") as f:
+        assert "secret-hash" not in f.read()
+
+
+def test_concurrent_payments_build_on_each_other(data):
+    threads = [threading.Thread(target=services.user_pay_due, args=("ravi", 1, 1)) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert dues() == (80.0, 80.0)
+    assert log_rows() == 20
+
+
+# ---------------- Crash injection ----------------
+@pytest.mark.parametrize("crash_at", ["customers", "dues", "log", "commit"])
+def test_crash_between_steps_is_replayed_once(data, monkeypatch, crash_at):
+    """Die before writing crash_at (intent is already durable), restart, and replay"""
+    monkeypatch.setattr(threading, "excepthook", lambda args: None)
+    journal = restart(monkeypatch, timeout=0.5)
+    save_csv, append_csv, write = services._save_csv, services._append_csv, journal._write
+
+    def save(df, file):
+        if (crash_at, file) in (("customers", services.CUSTOMERS_CSV), ("dues", services.DUES_CSV)):
+            raise Crash
+        save_csv(df, file)
+
+    def append(file, row):
+        if crash_at == "log":
+            raise Crash
+        append_csv(file, row)
+
+    def journal_write(records):
+        if crash_at == "commit" and records[0]["type"] == "commit":
+            raise Crash
+        write(records)
+
+    monkeypatch.setattr(services, "_save_csv", save)
+    monkeypatch.setattr(services, "_append_csv", append)
+    monkeypatch.setattr(journal, "_write", journal_write)
+    with pytest.raises(PaymentPending):
+        services.user_pay_due("ravi", 1, 10, idempotency_key="k1")
+
+    monkeypatch.setattr(services, "_save_csv", save_csv)
+    monkeypatch.setattr(services, "_append_csv", append_csv)
+    restart(monkeypatch)
+    assert dues() == (90.0, 90.0)
+    assert log_rows() == 1
+    assert services.user_pay_due("ravi", 1, 10, idempotency_key="k1")["due"] == 90.0
+    assert dues() == (90.0, 90.0)
+    assert log_rows() == 1
+
+
+def test_partial_payment_crash_is_replayed_once(data, monkeypatch):
+    monkeypatch.setattr(threading, "excepthook", lambda args: None)
+    restart(monkeypatch, timeout=0.5)
+    append_csv = services._append_csv
+
+    def append(file, row):
+        raise Crash
+
+    monkeypatch.setattr(services, "_append_csv", append)
+    with pytest.raises(PaymentPending):
+        services.record_partial_payment(2, 20, idempotency_key="p1")
+    monkeypatch.setattr(services, "_append_csv", append_csv)
+    restart(monkeypatch)
+    assert dues(2) == (30.0, 30.0)
+    assert log_rows(services.PARTIAL_CSV) == 1
+
+
+def test_torn_final_journal_line_is_dropped(data, monkeypatch):
+    services.user_pay_due("ravi", 1, 10, idempotency_key="k1")
+    with open(services.PAYMENT_JOURNAL, "a", encoding="utf-8") as f:
+        f.write('{"type": "intent", "ke')
+    restart(monkeypatch)
+    assert services.user_pay_due("ravi", 1, 5, idempotency_key="k2")["due"] == 85.0
+    assert services.user_pay_due("ravi", 1, 10, idempotency_key="k1")["due"] == 90.0
+    assert dues() == (85.0, 85.0)
+    journal_records()  # every line parses
+
+
+# ---------------- Failures ----------------
+def test_failed_apply_is_retried_not_aborted(data, monkeypatch):
+    save_csv = services._save_csv
+    failures = []
+
+    def flaky_save(df, file):
+        if file == services.DUES_CSV and not failures:
+            failures.append(file)
+            raise OSError("disk hiccup")
+        save_csv(df, file)
+
+    monkeypatch.setattr(services, "_save_csv", flaky_save)
+    assert services.user_pay_due("ravi", 1, 10, idempotency_key="k1")["due"] == 90.0
+    assert failures
+    assert dues() == (90.0, 90.0)
+    assert log_rows() == 1
+    assert not any(r["type"] == "abort" for r in journal_records())
+
+
+def test_failed_commit_write_is_retried_before_later_payments_commit(data, monkeypatch):
+    journal = services.payment_journal
+    write = journal._write
+    failures = []
+
+    def flaky_write(records):
+        if records[0]["type"] == "commit" and not failures:
+            failures.append(records)
+            raise OSError("disk hiccup")
+        write(records)
+
+    monkeypatch.setattr(journal, "_write", flaky_write)
+    assert services.user_pay_due("ravi", 1, 10, idempotency_key="k1")["due"] == 90.0
+    assert services.user_pay_due("ravi", 1, 50, idempotency_key="k2")["due"] == 40.0
+    assert failures
+    restart(monkeypatch)
+    assert dues() == (40.0, 40.0)
+    assert log_rows() == 2
+
+
+def test_csv_writers_wait_for_the_committer(data, monkeypatch):
+    save_csv = services._save_csv
+    loaded, release = threading.Event(), threading.Event()
+
+    def slow_save(df, file):
+        if file == services.CUSTOMERS_CSV and not release.is_set():
+            loaded.set()
+            release.wait(5)  # the batch has read customers.csv and is about to rewrite it
+        save_csv(df, file)
+
+    monkeypatch.setattr(services, "_save_csv", slow_save)
+    payment = threading.Thread(target=services.user_pay_due, args=("ravi", 1, 10))
+    payment.start()
+    assert loaded.wait(5)
+    admin = threading.Thread(target=services.update_due, args=(2, 7))
+    admin.start()
+    admin.join(0.2)
+    release.set()
+    payment.join()
+    admin.join()
+    assert dues(1) == (90.0, 90.0)
+    assert dues(2) == (7.0, 7.0)
+
+
+def test_admin_due_update_lands_after_journaled_payments(data, monkeypatch):
+    journal = services.payment_journal
+    apply_batch, queued, release = journal.apply_batch, threading.Event(), threading.Event()
+
+    def slow_apply(entries, replay):
+        queued.set()
+        release.wait(5)  # the payment is journaled but not applied yet
+        apply_batch(entries, replay)
+
+    monkeypatch.setattr(journal, "apply_batch", slow_apply)
+    payment = threading.Thread(target=services.user_pay_due, args=("ravi", 1, 10))
+    payment.start()
+    assert queued.wait(5)
+    admin = threading.Thread(target=services.update_due, args=(1, 7))
+    admin.start()
+    admin.join(0.2)
+    release.set()
+    payment.join()
+    admin.join()
+    assert dues(1) == (7.0, 7.0)
+
+
+def test_failed_intent_write_is_aborted_and_reported(data, monkeypatch):
+    journal = services.payment_journal
+    write = journal._write
+
+    def failing_write(records):
+        if records[0]["type"] == "intent":
+            raise OSError("disk full")
+        write(records)
+
+    monkeypatch.setattr(journal, "_write", failing_write)
+    assert services.user_pay_due("ravi", 1, 10, idempotency_key="k1") is None
+    assert dues() == (100.0, 100.0)
+
+    monkeypatch.setattr(journal, "_write", write)
+    assert services.user_pay_due("ravi", 1, 5, idempotency_key="k2")["due"] == 95.0
+    restart(monkeypatch)
+    assert dues() == (95.0, 95.0)
+
+
+def test_unwritable_journal_does_not_hang_callers(data, monkeypatch):
+    journal = restart(monkeypatch, timeout=0.5)
+
+    def failing_write(records):
+        raise OSError("EIO")
+
+    monkeypatch.setattr(journal, "_write", failing_write)
+    with pytest.raises(PaymentPending):
+        services.user_pay_due("ravi", 1, 10, idempotency_key="k1")
+    assert services.user_pay_due("ravi", 1, 5, idempotency_key="k2") is None
+    assert dues() == (100.0, 100.0)
+
+
+# ---------------- Compaction ----------------
+def test_compaction_keeps_recent_keys_and_bounds_the_journal(data, monkeypatch):
+    restart(monkeypatch, keep_keys=3, compact_every=2)
+    for i in range(8):
+        services.user_pay_due("ravi", 1, 1, idempotency_key=f"k{i}")
+    restart(monkeypatch, keep_keys=3, compact_every=2)
+    records = journal_records()
+    assert [r["type"] for r in records] == ["done"] * 3
+    assert services.user_pay_due("ravi", 1, 1, idempotency_key="k7")["due"] == 92.0
+    assert dues() == (92.0, 92.0)
+    assert log_rows() == 8
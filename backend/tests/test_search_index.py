@@ -0,0 +1,134 @@
+# backend/tests/test_search_index.py
+import pytest
+
+import backend.search_index as search_index
+from backend.search_index import CustomerSearchIndex
+
+CUSTOMERS = [
+    {"id": 1, "name": "Ravi Kumar", "phone": 9876543210.0, "email": "ravi@x.com", "username": "ravikumar"},
+    {"id": 2, "name": "Ravina Shah", "phone": "98200 11111", "email": float("nan"), "username": "ravinashah"},
+    {"id": 3, "name": "Priya Sharma", "phone": "9123443210", "email": "priya@y.in", "username": "priyasharma"},
+    {"id": 4, "name": "Karan Ravikiran", "phone": "9000000001", "email": "", "username": "karan"},
+]
+
+
+def _built(records=CUSTOMERS):
+    index = CustomerSearchIndex()
+    index.build(lambda: records)
+    return index
+
+
+def _ids(results):
+    return [r["id"] for r in results]
+
+
+def _names(*names):
+    return [{"id": i, "name": n, "phone": "", "email": "", "username": ""} for i, n in enumerate(names, 1)]
+
+
+def test_exact_ranks_before_prefix():
+    index = _built(_names("Shahid", "Shah", "Shahabuddin"))
+    assert _ids(index.search("shah")) == [2, 1, 3]
+
+
+def test_exact_match_skips_substring_and_typo_matches():
+    index = _built(_names("Shah", "Ashahar", "Shax"))
+    assert _ids(index.search("shah")) == [1]
+
+
+def test_prefix_before_substring_before_typo():
+    # No exact token and exact/prefix alone can't fill the limit, so the loose pass runs
+    index = _built(_names("Rahx", "Arahan", "Rahat"))
+    results = index.search("raha", limit=10)
+    assert _ids(results) == [3, 2, 1]
+    assert results[0]["score"] > results[1]["score"] > results[2]["score"]
+
+
+def test_exact_phone_skips_loose_matches():
+    index = _built()
+    assert _ids(index.search("9876543210")) == [1]
+    assert _ids(index.search("98765")) == [1]
+
+
+def test_phone_read_back_as_float_is_indexed_as_digits():
+    index = _built()
+    result = index.search("3210")
+    assert set(_ids(result)) == {1, 3}
+    assert next(r for r in result if r["id"] == 1)["phone"] == "9876543210"
+
+
+def test_multi_term_and_typo():
+    index = _built()
+    assert _ids(index.search("ravi kum")) == [1]
+    assert _ids(index.search("priya shrma")) == [3]
+    assert _ids(index.search("kumr")) == [1]
+
+
+@pytest.mark.parametrize("score_all_limit", [search_index._SCORE_ALL_LIMIT, 100])
+def test_rare_exact_pair_inside_two_large_name_groups(monkeypatch, score_all_limit):
+    # Scored in full, or (lower limit) walked best combination first past the cap
+    monkeypatch.setattr(search_index, "_SCORE_ALL_LIMIT", score_all_limit)
+    # Both groups are larger than the candidate cap; only id 9999 matches both terms
+    records = [{"id": 10 + i, "name": f"Priya X{i}", "phone": "", "email": "", "username": ""} for i in range(3000)]
+    records += [{"id": 5000 + i, "name": f"Y{i} Sharma", "phone": "", "email": "", "username": ""} for i in range(3000)]
+    records.append({"id": 9999, "name": "Priya Sharma", "phone": "", "email": "", "username": ""})
+    index = _built(records)
+    assert _ids(index.search("priya sharma")) == [9999]
+    assert _ids(index.search("sharma priya")) == [9999]
+    assert index.search("priya sharma")[0]["score"] == 2.0
+
+
+def test_email_query_matches_by_parts():
+    index = _built()
+    assert _ids(index.search("priya@y.in")) == [3]
+    assert index.search("ravi@x.com")[0]["id"] == 1
+
+
+def test_missing_email_is_blank():
+    index = _built()
+    assert index.search("ravinashah")[0]["email"] == ""
+
+
+def test_mutations_before_build_are_ignored_and_build_reads_loader():
+    index = CustomerSearchIndex()
+    index.add({"id": 9, "name": "Ghost", "phone": "", "email": "", "username": ""})
+    assert not index.ready
+    index.build(lambda: CUSTOMERS)
+    assert index.ready
+    assert index.search("ghost") == []
+    assert _ids(index.search("ravina")) == [2]
+
+
+def test_incremental_add_update_remove_clear():
+    index = _built()
+    index.add({"id": 5, "name": "Neha Verma", "phone": "9111122222", "email": "", "username": "kitekite"})
+    assert _ids(index.search("neha")) == [5]
+
+    index.update({"id": 5, "name": "Neha Verma", "phone": "9111122222", "email": "", "username": "zebra42"})
+    assert index.search("kitekite") == []
+    assert _ids(index.search("zebra42")) == [5]
+
+    index.remove(5)
+    assert index.search("neha") == []
+    assert index.search("9111122222") == []
+
+    index.clear()
+    assert index.search("ravi") == []
+    index.add({"id": 6, "name": "Arjun", "phone": "", "email": "", "username": ""})
+    assert _ids(index.search("arjun")) == [6]
+
+
+def test_mutations_during_build_are_replayed():
+    index = CustomerSearchIndex()
+
+    def loader():
+        yield CUSTOMERS[0]
+        # Arrive while the build is running, after the loader already read the CSV
+        index.add({"id": 7, "name": "Pooja Reddy", "phone": "", "email": "", "username": ""})
+        index.remove(1)
+        yield CUSTOMERS[1]
+
+    index.build(loader)
+    assert _ids(index.search("pooja")) == [7]
+    assert index.search("kumar") == []
+    assert _ids(index.search("ravina")) == [2]